@@ -14,6 +14,21 @@ the driver to access the underlying hardware.
 The link between the wifi module and the wifi driver is established without the programmer
 intervetion by the driver itself.
 
+The module looks the driver up in :samp:`__default_net["wifi"]` at first use and keeps it: a driver replacing
+an already used one must do it by calling :func:`register`.
+
+Besides the methods called by the functions below, a wifi driver can optionally provide the following ones,
+used by this module when available:
+
+    * :samp:`softap_config_raw(cfg)`: same as :samp:`softap_config(ip,gw,net)`, with *cfg* a 12 bytes object holding
+      the IP address, the gateway address and the netmask, in this order, each one as 4 bytes with the most significant
+      octet first (e.g. "192.168.0.1" is ``bytes((192,168,0,1))``).
+    * :samp:`gethostbyname_many(hosts,timeout)`: resolve all the host names in the list *hosts* (without duplicates), waiting at most
+      *timeout* milliseconds for the answers. Must return a sequence with the same length and order of *hosts*, holding the IPv4 address
+      of each host as a string, or None for a host that could not be resolved.
+    * :samp:`scan_stream(callback,duration)`: scan the available wifi networks for at most *duration* milliseconds, calling
+      :samp:`callback(SSID, network_security, RSSI, BSSID)` for each network as soon as it is found, without building the list of results.
+
 
 This module defines the following constants:
 
@@ -22,23 +37,174 @@ This module defines the following constants:
     * `WIFI_WPA`  = 2; Wifi Network secured with WPA
     * `WIFI_WPA2`  = 3; Wifi Network secured with WPA2
 
+If no wifi driver has been loaded, the functions of this module raise :samp:`WifiDriverNotLoaded`.
 
     """
 
+import timers
+import threading
+
+new_exception(WifiDriverNotLoaded,Exception,"No wifi driver loaded")
+
 WIFI_OPEN = 0
 WIFI_WEP = 1
 WIFI_WPA = 2
 WIFI_WPA2 = 3
 
+# wifi driver, bound once by register() or at first use
+_wifi = None
+
+# ready lists longer than this are converted to sets in select()
+_SELECT_SET_MIN = 8
+
+# last scan result and the time (in ms) it was taken
+_scan_cache = None
+_scan_ts = 0
+
+# hostname -> (ip, time in ms it was resolved) for recently resolved hosts
+_dns_cache = {}
+_DNS_CACHE_SIZE = 8
 
-def gethostbyname(hostname):
+# last rssi read and the time (in ms) it was taken
+_rssi_cache = None
+
+# last softap configuration as ((ip,gw,net), packed bytes)
+_softap_cfg = None
+
+# set while linked to an Access Point
+_link_event = threading.Event()
+# link status reported by the driver through notify_link(), None if the driver never reported it
+_linked = None
+
+# link_info() result for the current link, None when it must be asked to the driver
+_link_info = None
+
+
+def _get_wifi():
+    global _wifi
+    if _wifi is None:
+        if "wifi" not in __default_net:
+            raise WifiDriverNotLoaded
+        _wifi = __default_net["wifi"]
+    return _wifi
+
+def register(drv):
     """
-.. function:: gethostbyname(hostname)        
+.. function:: register(drv)
+
+        Set *drv* as the wifi driver used by this module. It is meant to be called by wifi drivers
+        when they are loaded, so that the module does not need to look the driver up at every call.
+        Drivers assigning :samp:`__default_net["wifi"]` directly are picked up only if no driver has been used yet.
+
+    """
+    global _wifi
+    __default_net["wifi"] = drv
+    _wifi = drv
+
+def notify_link(linked):
+    """
+.. function:: notify_link(linked)
+
+        Inform the module that the link with the Access Point has been established (*linked* is True) or lost
+        (*linked* is False), waking up the threads blocked in :func:`wait_linked`.
+        It is meant to be called by wifi drivers on association and disconnection events.
+
+    """
+    global _link_info
+    global _linked
+    _linked = linked
+    _link_info = None
+    if linked:
+        _link_event.set()
+    else:
+        _link_event.clear()
+
+def _link_changed(linked):
+    # after link()/unlink(), keep the status in sync for drivers that report link changes;
+    # for the others nothing is tracked and the driver is always asked
+    if _linked is not None:
+        notify_link(linked)
+
+
+def _dns_lookup(hostname,ttl,now):
+    if ttl>0 and hostname in _dns_cache:
+        ip, ts = _dns_cache[hostname]
+        if now-ts<ttl:
+            return ip
+    return None
+
+def _dns_store(hostname,ip,now):
+    if hostname not in _dns_cache and len(_dns_cache)>=_DNS_CACHE_SIZE:
+        # evict the oldest entry
+        oldest = None
+        for k in _dns_cache:
+            if oldest is None or _dns_cache[k][1]<_dns_cache[oldest][1]:
+                oldest = k
+        del _dns_cache[oldest]
+    _dns_cache[hostname] = (ip,now)
+
+def gethostbyname(hostname,ttl=60000):
+    """
+.. function:: gethostbyname(hostname,ttl=60000)
 
         Translate a host name to IPv4 address format. The IPv4 address is returned as a string, such as "192.168.0.5". 
+
+        Up to 8 resolved host names are remembered for *ttl* milliseconds, so that resolving the same host
+        again does not perform a new DNS query. A *ttl* of zero always queries the DNS.
                 
     """
-    return __default_net["wifi"].gethostbyname(hostname)
+    now = timers.now()
+    ip = _dns_lookup(hostname,ttl,now)
+    if ip is not None:
+        return ip
+    ip = _get_wifi().gethostbyname(hostname)
+    if ttl>0:
+        _dns_store(hostname,ip,now)
+    return ip
+
+def gethostbyname_many(hosts,ttl=60000,timeout=2000):
+    """
+.. function:: gethostbyname_many(hosts,ttl=60000,timeout=2000)
+
+        Translate each host name in *hosts* to IPv4 address format, as :func:`gethostbyname` does, and return
+        a dictionary mapping host names to IPv4 addresses. Host names already resolved less than *ttl* milliseconds ago are not queried again.
+
+        If the wifi driver supports it, the remaining queries are sent together and their answers are waited for at most *timeout* milliseconds;
+        otherwise the host names are resolved one after the other.
+
+        Host names that cannot be resolved are mapped to None.
+
+    """
+    res = {}
+    drv = _get_wifi()
+    if not hasattr(drv,"gethostbyname_many"):
+        for host in hosts:
+            if host in res:
+                continue
+            try:
+                res[host] = gethostbyname(host,ttl)
+            except Exception:
+                res[host] = None
+        return res
+    now = timers.now()
+    missing = []
+    for host in hosts:
+        if host in res or host in missing:
+            continue
+        ip = _dns_lookup(host,ttl,now)
+        if ip is not None:
+            res[host] = ip
+        else:
+            missing.append(host)
+    if missing:
+        ips = drv.gethostbyname_many(missing,timeout)
+        if len(ips)!=len(missing):
+            raise RuntimeError
+        for i,host in enumerate(missing):
+            res[host] = ips[i]
+            if ttl>0 and ips[i] is not None:
+                _dns_store(host,ips[i],now)
+    return res
 
 
 def select(rlist,wlist,xlist,timeout=None):
@@ -62,27 +228,109 @@ def select(rlist,wlist,xlist,timeout=None):
    becoming ready, three empty lists are returned.
        
     """
+    # fds are computed once and reused to pick the ready sockets, keeping the order of the arguments
     rrlist = [x.fileno() for x in rlist]
     wwlist = [y.fileno() for y in wlist]
     xxlist = [z.fileno() for z in xlist]
-    rl,wl,xl = __default_net["wifi"].select(rrlist,wwlist,xxlist,timeout)
-    rr = [x for x in rlist if x.fileno() in rl]
-    ww = [y for y in wlist if y.fileno() in wl]
-    xx = [z for z in xlist if z.fileno() in xl]
+    drv = _wifi
+    if drv is None:
+        drv = _get_wifi()
+    rl,wl,xl = drv.select(rrlist,wwlist,xxlist,timeout)
+    # set() is built element by element by the VM: only worth it for long ready lists
+    rs = set(rl) if len(rl)>_SELECT_SET_MIN else rl
+    ws = set(wl) if len(wl)>_SELECT_SET_MIN else wl
+    xs = set(xl) if len(xl)>_SELECT_SET_MIN else xl
+    rr = [rlist[i] for i,fd in enumerate(rrlist) if fd in rs]
+    ww = [wlist[i] for i,fd in enumerate(wwlist) if fd in ws]
+    xx = [xlist[i] for i,fd in enumerate(xxlist) if fd in xs]
     return (rr,ww,xx)
 
 
-def scan(duration=5000):
+def select_fds(rlist,wlist,xlist,timeout=None):
     """
-.. function:: scan(duration=5000)        
+.. function:: select_fds(rlist, wlist, xlist, timeout=None)
+
+   Same as :func:`select`, but the three sequences contain socket file descriptors (as returned by
+   the *fileno()* method of a socket) instead of socket instances.
+
+   The return value is a triple of lists of ready file descriptors. Since no mapping between sockets and
+   file descriptors is performed, this is the fastest way to wait on sockets for code that already
+   keeps track of their descriptors.
+
+    """
+    drv = _wifi
+    if drv is None:
+        drv = _get_wifi()
+    return drv.select(rlist,wlist,xlist,timeout)
+
+
+def scan(duration=5000,rescan=False,max_age_ms=30000,filter_ssids=None,filter_bssids=None):
+    """
+.. function:: scan(duration=5000,rescan=False,max_age_ms=30000,filter_ssids=None,filter_bssids=None)
 
         Return the list of available wifi networks as a tuple of tuples: (SSID, network_security, RSSI, BSSID).
 
         The format of RSSI depends on the specific wifi driver loaded.
 
         *duration* is the maximum time in milliseconds the scan can last.
+
+        The result of the last scan is kept and returned again if it is not older than *max_age_ms* milliseconds,
+        avoiding a new (blocking) scan by the driver; in this case *duration* is ignored. Pass *rescan* as True to always force a new scan.
+        The kept result is discarded by :func:`unlink`, :func:`station_on` and :func:`station_off`.
+
+        If *filter_ssids* and/or *filter_bssids* are given as sequences, only networks whose SSID is in *filter_ssids*
+        (hidden networks with an empty SSID never match) or whose BSSID is in *filter_bssids* are returned.
+        A kept result is filtered if available, but a new scan done for a filtered call is not kept (and discards the
+        previously kept one), so that the full list of networks does not stay in memory.
+    """
+    global _scan_cache
+    global _scan_ts
+    filtered = filter_ssids is not None or filter_bssids is not None
+    if rescan or _scan_cache is None or timers.now()-_scan_ts>=max_age_ms:
+        res = _get_wifi().scan(duration)
+        if not filtered:
+            _scan_cache = res
+            _scan_ts = timers.now()
+            return res
+        # an older kept result must not outlive this newer scan
+        _scan_cache = None
+    else:
+        res = _scan_cache
+        if not filtered:
+            return res
+    ssids = set(filter_ssids) if filter_ssids is not None else set()
+    bssids = set(filter_bssids) if filter_bssids is not None else set()
+    return tuple([r for r in res if (r[0] and r[0] in ssids) or r[3] in bssids])
+
+def scan_cb(callback,duration=5000):
+    """
+.. function:: scan_cb(callback,duration=5000)
+
+        Scan the available wifi networks calling *callback(SSID, network_security, RSSI, BSSID)* for each of them.
+
+        If the wifi driver supports it, networks are passed to *callback* as soon as they are found and the whole list is never kept in memory;
+        otherwise a new scan is done by the driver and its result is iterated. The result kept by :func:`scan` is neither used nor changed.
+
+        *duration* is the maximum time in milliseconds the scan can last.
     """
-    return __default_net["wifi"].scan(duration)
+    drv = _get_wifi()
+    if hasattr(drv,"scan_stream"):
+        drv.scan_stream(callback,duration)
+        return
+    for r in drv.scan(duration):
+        callback(r[0],r[1],r[2],r[3])
+
+def scan_soa(duration=5000,rescan=False,max_age_ms=30000):
+    """
+.. function:: scan_soa(duration=5000,rescan=False,max_age_ms=30000)
+
+        Same as :func:`scan`, but the available wifi networks are returned as a tuple of four tuples:
+        (SSIDs, network_securities, RSSIs, BSSIDs), where the i-th element of each tuple refers to the same network.
+
+        Useful when only one field is needed, e.g. to find the strongest signal with ``max(scan_soa()[2])``.
+    """
+    rows = scan(duration,rescan,max_age_ms)
+    return (tuple([r[0] for r in rows]),tuple([r[1] for r in rows]),tuple([r[2] for r in rows]),tuple([r[3] for r in rows]))
             
 def link(ssid,security,password=""):
     """
@@ -94,27 +342,39 @@ def link(ssid,security,password=""):
         An exception can be raised if the link is not successful.
 
     """
-    __default_net["wifi"].link(ssid,security,password)
+    _get_wifi().link(ssid,security,password)
+    _link_changed(True)
 
-def try_link(ssid,password,sec=WIFI_WPA2, attempts=5,delay=2000):
+def try_link(ssid,password,sec=WIFI_WPA2, attempts=5,delay=2000,max_delay=30000):
     """
-.. function:: try_link(ssid,password,sec=WIFI_WPA2, attempts=5,delay=2000)        
+.. function:: try_link(ssid,password,sec=WIFI_WPA2, attempts=5,delay=2000,max_delay=30000)
 
         Try to establish a link for with the Access Point handling the wifi network identified by *ssid*. *security* must be one
         of the WIFI_ constants, and *password* is needed if *security* is different from WIFI_OPEN
         
-        The driver will try to link through a number of *attepmts*, each attempt with a *delay* delay in ms.
-        An exception can be raised if the link is not successful.
+        The driver will try to link through a number of *attepmts*. After a failed attempt the function waits *delay* ms
+        before retrying; the wait is doubled at each failure, up to *max_delay* ms. The total time spent waiting never exceeds
+        *attempts*-1 times *delay* ms (8 seconds with the default values): once it is used up, the remaining attempts are made without waiting.
+        An exception can be raised if the link is not successful. A ValueError raised by the driver (invalid parameters)
+        is propagated immediately, without further attempts.
 
     """
     exc = None
-    for _ in range(attempts):
+    budget = (attempts-1)*delay
+    for i in range(attempts):
         try:
-            __default_net["wifi"].link(ssid, sec, password)
+            _get_wifi().link(ssid, sec, password)
+            _link_changed(True)
             break
+        except ValueError:
+            raise
         except Exception as e:
             exc = e
-            sleep(delay)
+            if i<attempts-1 and budget>0:
+                wait = min(delay,max_delay,budget)
+                sleep(wait)
+                budget -= wait
+                delay *= 2
     else:
         raise exc
 
@@ -125,16 +385,34 @@ def unlink():
         Disconnect from the currently linked wifi network.
 
     """ 
-    __default_net["wifi"].unlink()
-
-def rssi():
+    global _scan_cache
+    global _rssi_cache
+    _get_wifi().unlink()
+    _link_changed(False)
+    _dns_cache.clear()
+    _scan_cache = None
+    _rssi_cache = None
+
+def rssi(max_age_ms=0):
     """
-.. function:: get_rssi()        
+.. function:: rssi(max_age_ms=0)
 
         Return RSSI of the current wireless connection.
 
+        If *max_age_ms* is greater than zero, a value read from the driver less than *max_age_ms* milliseconds ago
+        is returned instead of reading it again; useful to limit driver calls when RSSI is polled frequently.
+
     """ 
-    return __default_net["wifi"].get_rssi()
+    global _rssi_cache
+    drv = _wifi
+    if drv is None:
+        drv = _get_wifi()
+    if max_age_ms<=0:
+        return drv.get_rssi()
+    now = timers.now()
+    if _rssi_cache is None or now-_rssi_cache[1]>=max_age_ms:
+        _rssi_cache = (drv.get_rssi(),now)
+    return _rssi_cache[0]
 
 def is_linked():
     """
@@ -142,8 +420,35 @@ def is_linked():
 
         Return True if linked to the Access Point
 
+        If the wifi driver reports link changes with :func:`notify_link`, the last reported status is returned without calling the driver.
+
     """ 
-    return __default_net["wifi"].is_linked()
+    if _linked is not None:
+        return _linked
+    drv = _wifi
+    if drv is None:
+        drv = _get_wifi()
+    return drv.is_linked()
+
+def wait_linked(timeout=None):
+    """
+.. function:: wait_linked(timeout=None)
+
+        Block until linked to the Access Point. Return True if linked, False if
+        *timeout* milliseconds passed without establishing the link. If *timeout* is None, wait forever.
+
+        If the wifi driver reports link changes with :func:`notify_link`, the calling thread sleeps until the link is reported;
+        otherwise the driver is polled every 100 milliseconds.
+
+    """
+    if _linked is not None:
+        return _link_event.wait(-1 if timeout is None else timeout)
+    start = timers.now()
+    while not _get_wifi().is_linked():
+        if timeout is not None and timers.now()-start>=timeout:
+            return False
+        sleep(100)
+    return True
 
 
 def set_link_info(ip,mask,gw,dns):
@@ -160,7 +465,9 @@ def set_link_info(ip,mask,gw,dns):
         If 0.0.0.0 is given, a default address will be used.
 
     """        
-    __default_net["wifi"].set_link_info(ip,mask,gw,dns)
+    global _link_info
+    _link_info = None
+    _get_wifi().set_link_info(ip,mask,gw,dns)
 
 def link_info():
     """
@@ -176,8 +483,16 @@ def link_info():
             * The DNS IP as a string
             * The MAC address of the wifi interface as a sequence of 6 bytes
 
+        If the wifi driver reports link changes with :func:`notify_link`, the same tuple is returned by subsequent calls
+        without querying the driver again, until the next reported change.
+
     """        
-    return __default_net["wifi"].link_info()
+    global _link_info
+    if not _linked:
+        return _get_wifi().link_info()
+    if _link_info is None:
+        _link_info = _get_wifi().link_info()
+    return _link_info
 
 def softap_init(ssid,sec,password="",max_conn=4):
     """
@@ -191,7 +506,16 @@ def softap_init(ssid,sec,password="",max_conn=4):
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].softap_init(ssid,sec,password,max_conn)
+    return _get_wifi().softap_init(ssid,sec,password,max_conn)
+
+def _packip(ip):
+    octets = [int(x) for x in ip.split(".")]
+    if len(octets)!=4:
+        raise ValueError
+    for x in octets:
+        if x<0 or x>255:
+            raise ValueError
+    return bytes(octets)
 
 def softap_config(ip="192.168.0.1",gw="192.168.0.1",net="255.255.255.0"):
     """
@@ -205,7 +529,13 @@ def softap_config(ip="192.168.0.1",gw="192.168.0.1",net="255.255.255.0"):
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].softap_config(ip,gw,net)
+    global _softap_cfg
+    drv = _get_wifi()
+    if not hasattr(drv,"softap_config_raw"):
+        return drv.softap_config(ip,gw,net)
+    if _softap_cfg is None or _softap_cfg[0]!=(ip,gw,net):
+        _softap_cfg = ((ip,gw,net),_packip(ip)+_packip(gw)+_packip(net))
+    return drv.softap_config_raw(_softap_cfg[1])
 
 def softap_get_info():
     """
@@ -221,7 +551,7 @@ def softap_get_info():
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].softap_get_info()
+    return _get_wifi().softap_get_info()
 
 def softap_off():
     """
@@ -234,7 +564,7 @@ def softap_off():
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].softap_off()
+    return _get_wifi().softap_off()
 
 def station_on():
     """
@@ -247,7 +577,9 @@ def station_on():
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].station_on()
+    global _scan_cache
+    _scan_cache = None
+    return _get_wifi().station_on()
 
 def station_off():
     """
@@ -260,4 +592,6 @@ def station_off():
 .. note:: Not guaranteed to be supported by every wifi driver!
 
     """        
-    return __default_net["wifi"].station_off()
+    global _scan_cache
+    _scan_cache = None
+    return _get_wifi().station_off()